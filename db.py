@@ -7,8 +7,26 @@ import os
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# Pool connessioni: 20 fisse + 40 di overflow (copre i thread degli endpoint sync),
+# riciclate ogni 30 min; se il pool è esaurito si fallisce dopo 5s invece di restare appesi.
+# LIFO: si riusano sempre le connessioni più calde, quelle in eccesso restano ferme e scadono col recycle
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "40"))
+
 # Crea engine e sessione
-engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    pool_timeout=5,
+    pool_use_lifo=True,
+    # INSERT multi-riga (insertmanyvalues): fino a 1000 righe per statement VALUES (...), (...)
+    insertmanyvalues_page_size=1000,
+    # cache degli statement compilati più ampia del default (500)
+    query_cache_size=1200,
+)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
 
 # Base per i modelli SQLAlchemy (in models.py)
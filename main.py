@@ -1,18 +1,31 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 from typing import Optional, List, Dict
 
+import logging
 import os
+import threading
 import requests
+from anyio import to_thread
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, HTTPException, Query, Header
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from fastapi import FastAPI, Depends, HTTPException, Query, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import func
-from sqlalchemy.orm import Session
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import case, delete, func, insert, select, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, raiseload, selectinload
 from jose import jwt, JWTError
-from passlib.hash import bcrypt
+from passlib.context import CryptContext
 from zoneinfo import ZoneInfo
 
-from db import Base, engine, get_db
+from cache import TTLCache
+from db import Base, DB_MAX_OVERFLOW, DB_POOL_SIZE, engine, get_db
+from migrate_db import upgrade_schema
 from models import (
     User,
     Food,
@@ -34,7 +47,25 @@ from schemas import (
 )
 
 load_dotenv()
-app = FastAPI(title="MacrosCoach API")
+logger = logging.getLogger("macroscoach")
+
+# ---------------- Threadpool ----------------
+# Gli endpoint sono `def` sincroni: FastAPI li esegue nel threadpool di AnyIO,
+# che di default ha 40 thread. Ogni richiesta tiene un thread per tutta l'attesa sul DB.
+# Default = connessioni massime del pool: più thread finirebbero solo in coda sul pool (pool_timeout),
+# meno quelle riservate al lavoro fuori dalle richieste (flush di RecentFoodBatcher, al massimo 2 in volo).
+DB_BACKGROUND_CONNECTIONS = 2
+# almeno 1 thread anche con un pool piccolo (DB_POOL_SIZE=1, DB_MAX_OVERFLOW=0): total_tokens=0 solleva
+THREADPOOL_SIZE = max(1, int(os.getenv("THREADPOOL_SIZE", str(DB_POOL_SIZE + DB_MAX_OVERFLOW - DB_BACKGROUND_CONNECTIONS))))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    yield
+    RECENT_FOODS.flush()
+
+# orjson: serializzazione delle risposte (dict annidati) molto più veloce del json standard
+app = FastAPI(title="MacrosCoach API", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # ---------------- CORS (dev: all) ----------------
 app.add_middleware(
@@ -45,14 +76,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ---------------- Errori ----------------
+# violazioni di vincoli DB -> 400 (il rollback lo fa la chiusura della sessione in get_db)
+@app.exception_handler(IntegrityError)
+def integrity_error_handler(request: Request, exc: IntegrityError):
+    return ORJSONResponse(status_code=400, content={"detail": f"Vincolo DB violato: {exc.orig}"})
+
 # ---------------- DB init ----------------
 Base.metadata.create_all(bind=engine)
+# DB esistenti: colonne/vincoli/indici aggiunti dopo la creazione delle tabelle
+upgrade_schema(engine)
 
 # ---------------- Auth utils ----------------
 SECRET = os.getenv("JWT_SECRET", "dev-secret-change-me")
 ALGO = "HS256"
 ACCESS_MINUTES = int(os.getenv("JWT_ACCESS_MIN", "60"))
 
+# Password: argon2id (parametri OWASP, ~10x più veloce di bcrypt cost 12 a parità di sicurezza);
+# gli hash bcrypt esistenti restano validi e vengono convertiti al primo login
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__time_cost=2,
+    argon2__memory_cost=19456,  # KiB
+    argon2__parallelism=1,
+)
+
 def create_access_token(user: User) -> str:
     payload = {
         "sub": str(user.id),
@@ -60,18 +109,23 @@ def create_access_token(user: User) -> str:
     }
     return jwt.encode(payload, SECRET, algorithm=ALGO)
 
-def get_current_user(
+def get_current_user_id(
     authorization: Optional[str] = Header(None, alias="Authorization"),
-    db: Session = Depends(get_db),
-) -> User:
+) -> int:
+    # solo verifica del JWT, nessuna query: per gli endpoint che usano soltanto l'id utente
     if not authorization or not authorization.lower().startswith("bearer "):
         raise HTTPException(status_code=401, detail="Missing bearer token")
     token = authorization.split(" ", 1)[1]
     try:
         data = jwt.decode(token, SECRET, algorithms=[ALGO])
-        uid = int(data.get("sub"))
+        return int(data.get("sub"))
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+
+def get_current_user(
+    uid: int = Depends(get_current_user_id),
+    db: Session = Depends(get_db),
+) -> User:
     u = db.get(User, uid)
     if not u:
         raise HTTPException(status_code=401, detail="User not found")
@@ -88,7 +142,7 @@ def auth_register(payload: RegisterIn, db: Session = Depends(get_db)):
     u = db.query(User).filter_by(email=payload.email).first()
     if u:
         raise HTTPException(status_code=400, detail="Email già registrata")
-    u = User(email=payload.email, password_hash=bcrypt.hash(payload.password), timezone=payload.timezone or "Europe/Rome")
+    u = User(email=payload.email, password_hash=pwd_context.hash(payload.password), timezone=payload.timezone or "Europe/Rome")
     db.add(u)
     db.commit()
     db.refresh(u)
@@ -97,8 +151,15 @@ def auth_register(payload: RegisterIn, db: Session = Depends(get_db)):
 @app.post("/auth/login", response_model=TokenOut)
 def auth_login(payload: LoginIn, db: Session = Depends(get_db)):
     u = db.query(User).filter_by(email=payload.email).first()
-    if not u or not u.password_hash or not bcrypt.verify(payload.password, u.password_hash):
+    if not u or not u.password_hash:
+        raise HTTPException(status_code=401, detail="Credenziali non valide")
+    ok, new_hash = pwd_context.verify_and_update(payload.password, u.password_hash)
+    if not ok:
         raise HTTPException(status_code=401, detail="Credenziali non valide")
+    if new_hash:
+        # hash legacy (bcrypt): riscrivilo con argon2
+        u.password_hash = new_hash
+        db.commit()
     return {"access_token": create_access_token(u)}
 
 @app.get("/users/me", response_model=MeOut)
@@ -110,15 +171,34 @@ def users_me(current: User = Depends(get_current_user)):
 def create_demo_user(db: Session = Depends(get_db)):
     u = db.query(User).filter_by(email="demo@example.com").first()
     if not u:
-        u = User(email="demo@example.com", password_hash=bcrypt.hash("demo"), timezone="Europe/Rome")
+        u = User(email="demo@example.com", password_hash=pwd_context.hash("demo"), timezone="Europe/Rome")
         db.add(u)
         db.commit()
         db.refresh(u)
     return {"user_id": u.id, "access_token": create_access_token(u)}
 
 # ---------------- Barcode / OFF lookup ----------------
+# Sessione HTTP condivisa: riusa le connessioni TCP+TLS verso OFF tra i fallback e tra le richieste.
+# Retry solo sugli errori di connessione (i read timeout da 10s non vengono ripetuti).
+OFF_URL = "https://world.openfoodfacts.org"
+# Campi usati da extract_payload: l'API v2 restituisce solo questi invece dell'intero prodotto
+OFF_FIELDS = "product_name,brands,generic_name,nutriments"
+OFF_HTTP = requests.Session()
+OFF_HTTP.mount(
+    "https://",
+    HTTPAdapter(pool_connections=20, pool_maxsize=100, max_retries=Retry(total=2, read=False, backoff_factor=0.2)),
+)
+# Thread per le due chiamate /product (v2 e v0) lanciate in parallelo
+OFF_POOL = ThreadPoolExecutor(max_workers=32, thread_name_prefix="off")
+# Risultati OFF per barcode (solo i trovati): i prodotti cambiano di rado, 24h vanno bene
+BARCODE_CACHE = TTLCache(maxsize=10_000, ttl=86400)
+
 @app.get("/foods/barcode/{code}")
 def food_by_barcode(code: str):
+    cached = BARCODE_CACHE.get(code)
+    if cached is not None:
+        return cached
+
     def extract_payload(p):
         if not p:
             return None
@@ -150,54 +230,32 @@ def food_by_barcode(code: str):
             },
         }
 
-    # 1) v2 /product
-    try:
-        r = requests.get(f"https://world.openfoodfacts.org/api/v2/product/{code}.json", timeout=10)
-        j = r.json()
+    def lookup(url: str, search: bool):
+        # search=True: endpoint di ricerca (lista "products") invece di /product
+        try:
+            j = OFF_HTTP.get(url, timeout=10).json()
+        except requests.RequestException:
+            return None
+        if search:
+            prods = j.get("products", []) or []
+            return extract_payload(prods[0]) if prods else None
         if j.get("status") == 1 and "product" in j:
-            out = extract_payload(j["product"])
-            if out:
-                return out
-    except requests.RequestException:
-        pass
-
-    # 2) v0 /product
-    try:
-        r0 = requests.get(f"https://world.openfoodfacts.org/api/v0/product/{code}.json", timeout=10)
-        j0 = r0.json()
-        if j0.get("status") == 1 and "product" in j0:
-            out = extract_payload(j0["product"])
-            if out:
-                return out
-    except requests.RequestException:
-        pass
-
-    # 3) v2 /search?code=
-    try:
-        rs2 = requests.get(f"https://world.openfoodfacts.org/api/v2/search?code={code}&page_size=1", timeout=10)
-        js2 = rs2.json()
-        prods = js2.get("products", []) or []
-        if prods:
-            out = extract_payload(prods[0])
-            if out:
-                return out
-    except requests.RequestException:
-        pass
-
-    # 4) legacy CGI search
-    try:
-        rl = requests.get(
-            f"https://world.openfoodfacts.org/cgi/search.pl?search_simple=1&json=1&code={code}&page_size=1",
-            timeout=10,
-        )
-        jl = rl.json()
-        prods = jl.get("products", []) or []
-        if prods:
-            out = extract_payload(prods[0])
-            if out:
-                return out
-    except requests.RequestException:
-        pass
+            return extract_payload(j["product"])
+        return None
+
+    # ordine di priorità: v2 /product, v0 /product, poi le ricerche (fuzzy) v2 /search e CGI legacy.
+    # I due /product partono in parallelo (se v2 manca, la risposta v0 è già pronta) ma vince sempre v2;
+    # le ricerche, più lente e con rate limit più stretti su OFF, solo se entrambi i /product mancano.
+    v2 = OFF_POOL.submit(lookup, f"{OFF_URL}/api/v2/product/{code}.json?fields={OFF_FIELDS}", False)
+    v0 = OFF_POOL.submit(lookup, f"{OFF_URL}/api/v0/product/{code}.json", False)
+    out = v2.result() or v0.result()
+    if not out:
+        out = lookup(f"{OFF_URL}/api/v2/search?code={code}&page_size=1&fields={OFF_FIELDS}", True)
+    if not out:
+        out = lookup(f"{OFF_URL}/cgi/search.pl?search_simple=1&json=1&code={code}&page_size=1", True)
+    if out:
+        BARCODE_CACHE.set(code, out)
+        return out
 
     raise HTTPException(status_code=404, detail=f"Barcode non trovato su OFF (code={code})")
 
@@ -206,38 +264,117 @@ def barcode_search(code: str):
     return food_by_barcode(code)
 
 # ---------------- Helper: schedule & slot ----------------
-def get_today_profile_and_distributions(current: User, db: Session):
-    tz = ZoneInfo(current.timezone or "Europe/Rome")
-    now_local = datetime.now(tz)
-    weekday = (now_local.weekday())  # 0 Mon .. 6 Sun
-    mode = db.query(UserDayMode).filter_by(user_id=current.id, weekday=weekday).first()
+# Profilo del giorno (ON/OFF, distribuzioni, limiti) per (user_id, weekday): il piano cambia di rado,
+# lo ricalcoliamo al massimo ogni 5 minuti. Invalidato da PUT /plan e PUT /schedule (solo su questo worker).
+PROFILE_CACHE = TTLCache(maxsize=10_000, ttl=300)
+# risposte già pronte di GET /plan e GET /schedule per user_id, stesse regole di invalidazione
+PLAN_CACHE = TTLCache(maxsize=10_000, ttl=300)
+SCHEDULE_CACHE = TTLCache(maxsize=10_000, ttl=300)
+
+# distribuzione "staccata" dalla sessione, sicura da tenere in cache;
+# pct = (carb, pro, fat) dal DistributionTarget con lo stesso nome, None se manca
+DistSlot = namedtuple("DistSlot", "name start_min end_min pct")
+
+# Generazione per utente, incrementata a ogni invalidazione: chi riempie la cache legge la generazione
+# PRIMA di interrogare il DB e scrive solo se nel frattempo non c'è stata un'invalidazione
+# (altrimenti una GET letta prima del commit di una PUT rimetterebbe in cache i dati vecchi per tutto il TTL).
+PLAN_CACHE_LOCK = threading.Lock()
+PLAN_CACHE_GEN: Dict[int, int] = {}
+
+def plan_cache_generation(user_id: int) -> int:
+    with PLAN_CACHE_LOCK:
+        return PLAN_CACHE_GEN.get(user_id, 0)
+
+def plan_cache_set(cache: TTLCache, key, user_id: int, generation: int, value):
+    with PLAN_CACHE_LOCK:
+        if PLAN_CACHE_GEN.get(user_id, 0) == generation:
+            cache.set(key, value)
+
+def invalidate_plan_caches(user_id: int):
+    with PLAN_CACHE_LOCK:
+        PLAN_CACHE_GEN[user_id] = PLAN_CACHE_GEN.get(user_id, 0) + 1
+        PROFILE_CACHE.delete(*((user_id, wd) for wd in range(7)))
+        PLAN_CACHE.delete(user_id)
+        SCHEDULE_CACHE.delete(user_id)
+
+def create_default_plan(db: Session, user_id: int) -> UserPlan:
+    # piano + distribuzioni di default in un solo flush: gli attributi restano in memoria,
+    # il chiamante costruisce la risposta e poi fa commit (niente refresh dopo il commit)
+    on_names = ["pre-workout", "intra-workout", "post-workout", "pranzo", "cena"]
+    off_names = ["colazione", "pranzo", "cena", "snack"]
+    plan = UserPlan(
+        user_id=user_id,
+        on_kcal=2600, on_carb=360, on_pro=194, on_fat=45,
+        off_kcal=2200, off_carb=200, off_pro=194, off_fat=55,
+        distributions=[
+            UserDistribution(is_on=True, name=n, sort_order=i) for i, n in enumerate(on_names)
+        ] + [
+            UserDistribution(is_on=False, name=n, sort_order=i) for i, n in enumerate(off_names)
+        ],
+        targets=[],
+    )
+    db.add(plan)
+    db.flush()
+    return plan
+
+def load_day_profile(user_id: int, weekday: int, db: Session):
+    mode = db.query(UserDayMode).filter_by(user_id=user_id, weekday=weekday).first()
     is_on = True if (mode and mode.is_on) else False
 
-    plan = db.query(UserPlan).filter_by(user_id=current.id).first()
-    if not plan:
+    plan = db.query(UserPlan).filter_by(user_id=user_id).first()
+    created = plan is None
+    if created:
         # bootstrap plan on first access
-        plan = UserPlan(
-            user_id=current.id,
-            on_kcal=2600, on_carb=360, on_pro=194, on_fat=45,
-            off_kcal=2200, off_carb=200, off_pro=194, off_fat=55,
-        )
-        db.add(plan); db.flush()
-        on_names = ["pre-workout", "intra-workout", "post-workout", "pranzo", "cena"]
-        off_names = ["colazione", "pranzo", "cena", "snack"]
-        for i, n in enumerate(on_names):
-            db.add(UserDistribution(plan_id=plan.id, is_on=True, name=n, sort_order=i))
-        for i, n in enumerate(off_names):
-            db.add(UserDistribution(plan_id=plan.id, is_on=False, name=n, sort_order=i))
-        db.commit(); db.refresh(plan)
-
-    dists = db.query(UserDistribution)        .filter(UserDistribution.plan_id==plan.id, UserDistribution.is_on==is_on)        .order_by(UserDistribution.sort_order.asc())        .all()
+        plan = create_default_plan(db, user_id)
+        dists = sorted((d for d in plan.distributions if d.is_on == is_on), key=lambda d: d.sort_order)
+        pct_map = {}
+    else:
+        dists = db.query(UserDistribution)        .filter(UserDistribution.plan_id==plan.id, UserDistribution.is_on==is_on)        .order_by(UserDistribution.sort_order.asc())        .all()
+        targets = db.execute(
+            select(DistributionTarget.name, DistributionTarget.pct_carb, DistributionTarget.pct_pro, DistributionTarget.pct_fat)
+            .where(DistributionTarget.plan_id==plan.id, DistributionTarget.is_on==is_on)
+        ).all()
+        pct_map = {name: (carb, pro, fat) for name, carb, pro, fat in targets}
     limits = {
         "kcal": plan.on_kcal if is_on else plan.off_kcal,
         "carb": plan.on_carb if is_on else plan.off_carb,
         "pro":  plan.on_pro  if is_on else plan.off_pro,
         "fat":  plan.on_fat  if is_on else plan.off_fat,
     }
-    return is_on, dists, limits, tz, now_local
+    profile = (is_on, tuple(DistSlot(d.name, d.start_min, d.end_min, pct_map.get(d.name)) for d in dists), limits)
+    if created:
+        db.commit()
+    return profile
+
+def get_today_profile_and_distributions(current: User, db: Session):
+    tz = ZoneInfo(current.timezone or "Europe/Rome")
+    now_local = datetime.now(tz)
+    weekday = (now_local.weekday())  # 0 Mon .. 6 Sun
+    uid = current.id
+    key = (uid, weekday)
+    profile = PROFILE_CACHE.get(key)
+    if profile is None:
+        generation = plan_cache_generation(uid)
+        profile = load_day_profile(uid, weekday, db)
+        plan_cache_set(PROFILE_CACHE, key, uid, generation, profile)
+    is_on, dists, limits = profile
+    return is_on, dists, dict(limits), tz, now_local
+
+def local_days_utc(start: datetime, days: int, tz: ZoneInfo):
+    # [mezzanotte locale di `start`, +days giorni) nel fuso tz, convertiti in UTC naive come sono salvati i `when`
+    d0_local = start.replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=tz)
+    d1_local = d0_local + timedelta(days=days)
+    return (
+        d0_local.astimezone(timezone.utc).replace(tzinfo=None),
+        d1_local.astimezone(timezone.utc).replace(tzinfo=None),
+    )
+
+def local_day_bounds_utc(now_local: datetime):
+    return local_days_utc(now_local, 1, now_local.tzinfo)
+
+def local_date(col, tz_name: str):
+    # data locale (fuso dell'utente) di una colonna UTC naive, calcolata in SQL
+    return func.date(func.timezone(tz_name, func.timezone("UTC", col)))
 
 def auto_slot_for_now(current: User, db: Session) -> str:
     is_on, dists, _, tz, now_local = get_today_profile_and_distributions(current, db)
@@ -258,10 +395,17 @@ def auto_slot_for_now(current: User, db: Session) -> str:
     raise HTTPException(status_code=400, detail="Nessuna distribuzione corrisponde all'orario corrente: definisci le fasce in Impostazioni.")
 
 # ---------------- Foods search ----------------
-@app.get("/foods/search", response_model=List[FoodSearchOut])
-def foods_search(q: str, limit: int = 20, db: Session = Depends(get_db), current: User = Depends(get_current_user)):
+@app.get("/foods/search", response_model=List[FoodSearchOut], dependencies=[Depends(get_current_user_id)])
+def foods_search(q: str, limit: int = 20, db: Session = Depends(get_db)):
+    # ILIKE '%q%' usa l'indice trigram GIN (ix_foods_name_trgm); i più simili alla query per primi
     ql = f"%{q}%"
-    rows = db.query(Food).filter(Food.name.ilike(ql)).order_by(Food.name.asc()).limit(limit).all()
+    rows = (
+        db.query(Food)
+        .filter(Food.name.ilike(ql))
+        .order_by(func.similarity(Food.name, q).desc(), Food.name.asc())
+        .limit(limit)
+        .all()
+    )
     out = []
     for f in rows:
         out.append({
@@ -277,12 +421,12 @@ def foods_search(q: str, limit: int = 20, db: Session = Depends(get_db), current
 def foods_recent(
     limit: int = 10,
     db: Session = Depends(get_db),
-    current: User = Depends(get_current_user),
+    uid: int = Depends(get_current_user_id),
 ):
     rows = (
         db.query(RecentFood, Food)
         .join(Food, RecentFood.food_id == Food.id)
-        .filter(RecentFood.user_id == current.id)
+        .filter(RecentFood.user_id == uid)
         .order_by(RecentFood.last_used.desc())
         .limit(limit)
         .all()
@@ -303,25 +447,30 @@ def foods_recent_by_slot(
     slot: str,
     limit: int = 10,
     db: Session = Depends(get_db),
-    current: User = Depends(get_current_user),
+    uid: int = Depends(get_current_user_id),
 ):
-    # ultimi meal items con quello slot per l'utente
-    items = (
-        db.query(MealItem, Meal, Food)
+    # ultimo meal item per ogni alimento (food_id, o nome se inserito a mano) con quello slot:
+    # dedup con DISTINCT ON in Postgres, così `limit` conta alimenti distinti e non righe
+    # chiave a due colonne: un nome manuale "42" non collide col food_id 42
+    key = (MealItem.food_id, case((MealItem.food_id.is_(None), MealItem.food_name)))
+    latest = (
+        db.query(MealItem.id.label("item_id"), Meal.when.label("last_when"))
         .join(Meal, Meal.id == MealItem.meal_id)
+        .filter(Meal.user_id == uid, Meal.slot == slot)
+        .distinct(*key)
+        .order_by(*key, Meal.when.desc(), MealItem.id.desc())
+        .subquery()
+    )
+    items = (
+        db.query(MealItem, Food)
+        .join(latest, latest.c.item_id == MealItem.id)
         .join(Food, Food.id == MealItem.food_id, isouter=True)
-        .filter(Meal.user_id == current.id, Meal.slot == slot)
-        .order_by(Meal.when.desc())
+        .order_by(latest.c.last_when.desc(), latest.c.item_id.desc())
         .limit(limit)
         .all()
     )
     out = []
-    seen = set()
-    for it, m, f in items:
-        key = f.id if f else it.food_name
-        if key in seen:
-            continue
-        seen.add(key)
+    for it, f in items:
         out.append({
             "food_id": f.id if f else None,
             "name": f.name if f else it.food_name,
@@ -336,6 +485,49 @@ def foods_recent_by_slot(
         })
     return out
 
+# "tocchi" ai cibi recenti raccolti per ~10ms e scritti con un unico INSERT ... ON CONFLICT multi-riga,
+# invece di un round-trip per richiesta. Per worker; va chiamato DOPO il commit (FK su foods).
+RECENT_FOOD_UPSERT = pg_insert(RecentFood)
+RECENT_FOOD_UPSERT = RECENT_FOOD_UPSERT.on_conflict_do_update(
+    constraint="uq_recent_food_user_food",
+    set_={"last_used": RECENT_FOOD_UPSERT.excluded.last_used},
+)
+
+class RecentFoodBatcher:
+    def __init__(self, window: float = 0.01):
+        self.window = window
+        self._pending: Dict[tuple, datetime] = {}
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+
+    def touch(self, user_id: int, food_id: int):
+        with self._lock:
+            # stessa coppia nella finestra -> una sola riga (ON CONFLICT non accetta doppioni nello stesso statement)
+            self._pending[(user_id, food_id)] = datetime.utcnow()
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            rows = [{"user_id": u, "food_id": f, "last_used": t} for (u, f), t in self._pending.items()]
+            self._pending.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not rows:
+            return
+        # gira nel thread del Timer: un errore non deve diventare un traceback non gestito.
+        # I tocchi persi influiscono solo sull'ordinamento dei recenti, quindi si logga e basta.
+        try:
+            with engine.begin() as conn:
+                conn.execute(RECENT_FOOD_UPSERT, rows)
+        except Exception:
+            logger.exception("flush recent_foods fallito: %d tocchi persi", len(rows))
+
+RECENT_FOODS = RecentFoodBatcher()
+
 @app.put("/foods/barcode/{code}")
 def upsert_food_by_barcode(
     code: str,
@@ -343,28 +535,34 @@ def upsert_food_by_barcode(
     db: Session = Depends(get_db),
     current: User = Depends(get_current_user),
 ):
+    uid = current.id
     name = (payload.name or '').strip()
     if not name:
         raise HTTPException(status_code=400, detail='Nome alimento obbligatorio')
     per100 = payload.per_100g
     try:
-        food = db.query(Food).filter_by(barcode=code).first()
-        if not food:
-            food = Food(barcode=code)
-            db.add(food)
-            db.flush()
-        food.name = name
-        food.per_100g_kcal = per100.kcal or 0
-        food.per_100g_pro = per100.pro or 0
-        food.per_100g_carb = per100.carb or 0
-        food.per_100g_fat = per100.fat or 0
-        rf = db.query(RecentFood).filter_by(user_id=current.id, food_id=food.id).first()
-        if rf:
-            rf.last_used = datetime.utcnow()
-        else:
-            db.add(RecentFood(user_id=current.id, food_id=food.id))
-        db.commit()
-        return {
+        # crea o aggiorna il Food del barcode in un solo statement
+        stmt = pg_insert(Food).values(
+            barcode=code,
+            name=name,
+            per_100g_kcal=per100.kcal or 0,
+            per_100g_pro=per100.pro or 0,
+            per_100g_carb=per100.carb or 0,
+            per_100g_fat=per100.fat or 0,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Food.barcode],
+            set_={
+                "name": stmt.excluded.name,
+                "per_100g_kcal": stmt.excluded.per_100g_kcal,
+                "per_100g_pro": stmt.excluded.per_100g_pro,
+                "per_100g_carb": stmt.excluded.per_100g_carb,
+                "per_100g_fat": stmt.excluded.per_100g_fat,
+            },
+        )
+        food = db.scalars(stmt.returning(Food), execution_options={"populate_existing": True}).one()
+        # letti prima del commit: dopo, ogni attributo scaduto costerebbe un SELECT
+        out = {
             'food_id': food.id,
             'name': food.name,
             'barcode': food.barcode,
@@ -375,40 +573,57 @@ def upsert_food_by_barcode(
                 'fat': food.per_100g_fat,
             },
         }
+        db.commit()
+        RECENT_FOODS.touch(uid, out['food_id'])
+        return out
     except HTTPException:
         raise
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=f'Errore salvataggio alimento: {e}')
 # ---------------- Meals ----------------
+def macro_sums():
+    # SUM dei grammi di pro/carb/fat (colonne generate su meal_items), 0 se non ci sono item
+    return (
+        func.coalesce(func.sum(MealItem.pro_g), 0.0).label("pro"),
+        func.coalesce(func.sum(MealItem.carb_g), 0.0).label("carb"),
+        func.coalesce(func.sum(MealItem.fat_g), 0.0).label("fat"),
+    )
+
 @app.post("/meals")
 def create_meal(
     meal: MealIn,
     db: Session = Depends(get_db),
     current: User = Depends(get_current_user),
 ):
+    uid = current.id
     try:
         slot = meal.slot
         if not slot:
             # se non fornito (es. inserimento rapido), deduci da schedule+fasce
             slot = auto_slot_for_now(current, db)
 
-        m = Meal(user_id=current.id, when=meal.when, slot=slot)
+        m = Meal(user_id=uid, when=meal.when, slot=slot)
         db.add(m)
         db.flush()
-        for it in meal.items:
-            db.add(
-                MealItem(
-                    meal_id=m.id,
-                    food_name=it.food_name,
-                    grams=it.grams,
-                    pro=it.pro,
-                    carb=it.carb,
-                    fat=it.fat,
-                )
+        # tutti gli item in un solo INSERT multi-riga (executemany)
+        if meal.items:
+            db.execute(
+                insert(MealItem),
+                [
+                    {
+                        "meal_id": m.id,
+                        "food_name": it.food_name,
+                        "grams": it.grams,
+                        "pro": it.pro,
+                        "carb": it.carb,
+                        "fat": it.fat,
+                    }
+                    for it in meal.items
+                ],
             )
         db.commit()
-        return {"ok": True, "meal_id": m.id, "user_id": current.id, "slot": slot}
+        return {"ok": True, "meal_id": m.id, "user_id": uid, "slot": slot}
     except HTTPException:
         raise
     except Exception as e:
@@ -424,38 +639,40 @@ def add_meal_from_barcode(
     db: Session = Depends(get_db),
     current: User = Depends(get_current_user),
 ):
+    uid = current.id
     # lookup OFF
     data = food_by_barcode(code)
     per100 = data["per_100g"] or {}
 
-    # trova/crea Food
-    food = db.query(Food).filter_by(barcode=code).first()
-    if not food:
-        food = Food(
-            name=data["name"],
-            barcode=code,
-            per_100g_kcal=per100.get("kcal") or 0,
-            per_100g_pro=per100.get("pro") or 0,
-            per_100g_carb=per100.get("carb") or 0,
-            per_100g_fat=per100.get("fat") or 0,
-        )
-        db.add(food)
-        db.flush()
+    # trova/crea Food: INSERT ... ON CONFLICT DO NOTHING (nessuna scrittura né lock di riga se il barcode
+    # esiste già); il RETURNING è vuoto in quel caso e si legge la riga esistente
+    stmt = pg_insert(Food).values(
+        name=data["name"],
+        barcode=code,
+        per_100g_kcal=per100.get("kcal") or 0,
+        per_100g_pro=per100.get("pro") or 0,
+        per_100g_carb=per100.get("carb") or 0,
+        per_100g_fat=per100.get("fat") or 0,
+    ).on_conflict_do_nothing(index_elements=[Food.barcode])
+    food = db.scalars(stmt.returning(Food), execution_options={"populate_existing": True}).one_or_none()
+    if food is None:
+        food = db.scalars(select(Food).where(Food.barcode == code)).one()
 
     # determina slot
     if not slot:
         slot = auto_slot_for_now(current, db)
 
     # crea Meal + Item
-    m = Meal(user_id=current.id, when=when or datetime.utcnow(), slot=slot)
+    m = Meal(user_id=uid, when=when or datetime.utcnow(), slot=slot)
     db.add(m)
     db.flush()
 
+    meal_id, food_id, food_name = m.id, food.id, food.name
     db.add(
         MealItem(
-            meal_id=m.id,
-            food_id=food.id,
-            food_name=food.name,
+            meal_id=meal_id,
+            food_id=food_id,
+            food_name=food_name,
             grams=grams,
             pro=food.per_100g_pro or 0,
             carb=food.per_100g_carb or 0,
@@ -463,37 +680,36 @@ def add_meal_from_barcode(
         )
     )
 
-    # aggiorna recenti
-    rf = db.query(RecentFood).filter_by(user_id=current.id, food_id=food.id).first()
-    if rf:
-        rf.last_used = datetime.utcnow()
-    else:
-        db.add(RecentFood(user_id=current.id, food_id=food.id))
-
     db.commit()
-    return {"ok": True, "meal_id": m.id, "food": food.name, "grams": grams, "slot": slot}
+
+    # aggiorna recenti (batch, dopo il commit: il Food potrebbe essere appena stato creato);
+    # solo valori locali, gli oggetti ORM sono scaduti dal commit
+    RECENT_FOODS.touch(uid, food_id)
+    return {"ok": True, "meal_id": meal_id, "food": food_name, "grams": grams, "slot": slot}
 
 @app.get("/meals/today")
 def meals_today(db: Session = Depends(get_db), current: User = Depends(get_current_user)):
+    uid = current.id
     # decide ON/OFF + dists + limits
     is_on, dists, limits, tz, now_local = get_today_profile_and_distributions(current, db)
 
-    d0_local = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
-    d1_local = d0_local + timedelta(days=1)
-    # convert bounds to UTC for querying naive UTC timestamps (assuming stored naive as UTC)
-    d0 = d0_local.astimezone(timezone.utc).replace(tzinfo=None)
-    d1 = d1_local.astimezone(timezone.utc).replace(tzinfo=None)
+    d0, d1 = local_day_bounds_utc(now_local)
 
-    meals = db.query(Meal).filter(Meal.user_id == current.id, Meal.when >= d0, Meal.when < d1).all()
+    # un'unica query aggregata: totali per pasto calcolati dal DB (outer join per i pasti senza item)
+    meals = (
+        db.query(Meal.id, Meal.when, Meal.slot, *macro_sums())
+        .outerjoin(MealItem, MealItem.meal_id == Meal.id)
+        .filter(Meal.user_id == uid, Meal.when >= d0, Meal.when < d1)
+        .group_by(Meal.id, Meal.when, Meal.slot)
+        .order_by(Meal.when.asc(), Meal.id.asc())
+        .all()
+    )
     result = []
     tot_pro = tot_carb = tot_fat = 0.0
     slot_stats: Dict[str, Dict[str, float]] = {}
 
     for m in meals:
-        items = db.query(MealItem).filter(MealItem.meal_id == m.id).all()
-        pro = sum(i.pro * (i.grams / 100.0) for i in items)
-        carb = sum(i.carb * (i.grams / 100.0) for i in items)
-        fat = sum(i.fat * (i.grams / 100.0) for i in items)
+        pro, carb, fat = m.pro, m.carb, m.fat
         kcal = pro * 4 + carb * 4 + fat * 9
         tot_pro += pro
         tot_carb += carb
@@ -513,27 +729,19 @@ def meals_today(db: Session = Depends(get_db), current: User = Depends(get_curre
         s["pro"] += pro; s["carb"] += carb; s["fat"] += fat; s["kcal"] += kcal
         slot_stats[m.slot] = s
 
-    # targets by slot using DistributionTarget (fallback uniform if missing)
-    targets = db.query(DistributionTarget).join(UserPlan, UserPlan.id==DistributionTarget.plan_id)        .filter(UserPlan.user_id==current.id, DistributionTarget.is_on==is_on).all()
-    pct_map = {t.name: {"carb": t.pct_carb, "pro": t.pct_pro, "fat": t.pct_fat} for t in targets}
-    # if missing, build uniform across defined distributions
-    names = [d.name for d in dists]
-    n = max(1, len(names))
-    def pct_or_uniform(name: str, key: str) -> float:
-        if name in pct_map:
-            return pct_map[name][key]
-        return 100.0 / n
-
+    # targets by slot: percentuali DistributionTarget già nel profilo in cache (fallback uniform if missing)
+    uniform = 100.0 / max(1, len(dists))
     by_slot = []
-    for name in names:
+    for d in dists:
+        pct_carb, pct_pro, pct_fat = d.pct if d.pct is not None else (uniform, uniform, uniform)
         tgt = {
-            "carb": limits["carb"] * pct_or_uniform(name, "carb") / 100.0,
-            "pro":  limits["pro"]  * pct_or_uniform(name, "pro")  / 100.0,
-            "fat":  limits["fat"]  * pct_or_uniform(name, "fat")  / 100.0,
+            "carb": limits["carb"] * pct_carb / 100.0,
+            "pro":  limits["pro"]  * pct_pro  / 100.0,
+            "fat":  limits["fat"]  * pct_fat  / 100.0,
         }
         tgt["kcal"] = tgt["carb"]*4 + tgt["pro"]*4 + tgt["fat"]*9
-        used = slot_stats.get(name, {"kcal":0.0, "pro":0.0, "carb":0.0, "fat":0.0})
-        by_slot.append({"slot": name, "used": used, "target": tgt})
+        used = slot_stats.get(d.name, {"kcal":0.0, "pro":0.0, "carb":0.0, "fat":0.0})
+        by_slot.append({"slot": d.name, "used": used, "target": tgt})
 
     day = {"kcal": tot_pro * 4 + tot_carb * 4 + tot_fat * 9, "pro": tot_pro, "carb": tot_carb, "fat": tot_fat}
     return {"kcal_limits": limits, "is_on": is_on, "day_totals": day, "by_slot": by_slot, "meals": result}
@@ -542,20 +750,24 @@ def meals_today(db: Session = Depends(get_db), current: User = Depends(get_curre
 def get_meal(
     meal_id: int,
     db: Session = Depends(get_db),
-    current: User = Depends(get_current_user),
+    uid: int = Depends(get_current_user_id),
 ):
-    m = db.query(Meal).filter(Meal.id == meal_id, Meal.user_id == current.id).first()
+    m = (
+        db.query(Meal)
+        .options(selectinload(Meal.items))
+        .filter(Meal.id == meal_id, Meal.user_id == uid)
+        .first()
+    )
     if not m:
         raise HTTPException(status_code=404, detail="Meal non trovato")
 
-    items = db.query(MealItem).filter(MealItem.meal_id == m.id).all()
     return {
         "meal_id": m.id,
         "when": m.when.isoformat(),
         "slot": m.slot,
         "items": [
             {"food_name": it.food_name, "grams": it.grams, "pro": it.pro, "carb": it.carb, "fat": it.fat}
-            for it in items
+            for it in m.items
         ],
     }
 
@@ -566,10 +778,11 @@ def update_meal(
     db: Session = Depends(get_db),
     current: User = Depends(get_current_user),
 ):
+    uid = current.id
     item = (
         db.query(MealItem)
         .join(Meal, Meal.id == MealItem.meal_id)
-        .filter(MealItem.meal_id == meal_id, Meal.user_id == current.id)
+        .filter(MealItem.meal_id == meal_id, Meal.user_id == uid)
         .first()
     )
     if not item:
@@ -599,17 +812,18 @@ def update_meal(
 # ---------------- Weight ----------------
 @app.post("/weight")
 def add_weight(w: WeightIn, db: Session = Depends(get_db), current: User = Depends(get_current_user)):
+    uid = current.id
     try:
-        db.add(WeightLog(user_id=current.id, when=w.when, kg=w.kg))
+        db.add(WeightLog(user_id=uid, when=w.when, kg=w.kg))
         db.commit()
-        return {"ok": True, "user_id": current.id}
+        return {"ok": True, "user_id": uid}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=f"Errore add_weight: {e}")
 
 @app.get("/weights/all")
-def weights_all(db: Session = Depends(get_db), current: User = Depends(get_current_user)):
-    rows = db.query(WeightLog).filter(WeightLog.user_id == current.id).order_by(WeightLog.when.asc()).all()
+def weights_all(db: Session = Depends(get_db), uid: int = Depends(get_current_user_id)):
+    rows = db.query(WeightLog).filter(WeightLog.user_id == uid).order_by(WeightLog.when.asc()).all()
     return [{"id": r.id, "when": r.when.isoformat(), "kg": r.kg} for r in rows]
 
 @app.get("/weights/range")
@@ -617,7 +831,7 @@ def weights_range(
     start: str,
     end: str,
     db: Session = Depends(get_db),
-    current: User = Depends(get_current_user),
+    uid: int = Depends(get_current_user_id),
 ):
     # parse start
     try:
@@ -638,134 +852,119 @@ def weights_range(
 
     rows = (
         db.query(WeightLog)
-        .filter(WeightLog.user_id == current.id, WeightLog.when >= d0, WeightLog.when < d1)
+        .filter(WeightLog.user_id == uid, WeightLog.when >= d0, WeightLog.when < d1)
         .order_by(WeightLog.when.asc())
         .all()
     )
     return [{"id": r.id, "when": r.when.isoformat(), "kg": r.kg} for r in rows]
 
 @app.get("/weights/weekly")
-def weights_weekly(db: Session = Depends(get_db), current: User = Depends(get_current_user)):
-    rows = db.query(WeightLog).filter(WeightLog.user_id == current.id).order_by(WeightLog.when.asc()).all()
-    if not rows:
-        return []
-    weekly = {}
-    for r in rows:
-        d = r.when.date()
-        week_start = d - timedelta(days=d.weekday())  # lunedì
-        key = week_start.isoformat()
-        w = weekly.get(key, {"week_start": key, "values": []})
-        w["values"].append(r.kg)
-        weekly[key] = w
-    out = []
-    for k in sorted(weekly.keys()):
-        vals = weekly[k]["values"]
-        avg = sum(vals) / len(vals)
-        out.append({"week_start": k, "avg": round(avg, 2), "min": min(vals), "max": max(vals), "n": len(vals)})
-    return out
+def weights_weekly(db: Session = Depends(get_db), uid: int = Depends(get_current_user_id)):
+    # settimane ISO (da lunedì) aggregate da Postgres: una riga per settimana invece di una per pesata
+    week = func.date_trunc("week", WeightLog.when).label("week")
+    rows = (
+        db.query(week, func.avg(WeightLog.kg), func.min(WeightLog.kg), func.max(WeightLog.kg), func.count(WeightLog.id))
+        .filter(WeightLog.user_id == uid)
+        .group_by(week)
+        .order_by(week)
+        .all()
+    )
+    return [
+        {"week_start": wk.date().isoformat(), "avg": round(avg, 2), "min": mn, "max": mx, "n": n}
+        for wk, avg, mn, mx, n in rows
+    ]
 
 @app.get("/weights/trend")
-def weights_trend(db: Session = Depends(get_db), current: User = Depends(get_current_user)):
-    rows = db.query(WeightLog).filter(WeightLog.user_id == current.id).order_by(WeightLog.when.asc()).all()
-    if len(rows) < 2:
+def weights_trend(db: Session = Depends(get_db), uid: int = Depends(get_current_user_id)):
+    # regressione lineare kg ~ giorni calcolata da Postgres: nessuna riga trasferita in Python.
+    # regr_slope è NULL con meno di 2 pesate o con tutte le pesate nello stesso istante
+    days = func.extract("epoch", WeightLog.when) / 86400.0  # giorni decimali
+    slope = db.query(func.regr_slope(WeightLog.kg, days)).filter(WeightLog.user_id == uid).scalar()
+    if slope is None:
         return {"slope_kg_per_week": None}
-
-    x = []
-    y = []
-    t0 = rows[0].when
-    for r in rows:
-        days = (r.when - t0).total_seconds() / (60 * 60 * 24)  # giorni decimali
-        x.append(days)
-        y.append(r.kg)
-
-    n = len(x)
-    sumx, sumy = sum(x), sum(y)
-    sumxy = sum(a * b for a, b in zip(x, y))
-    sumx2 = sum(a * a for a in x)
-    denom = n * sumx2 - sumx * sumx
-    if denom == 0:
-        return {"slope_kg_per_week": None}
-
-    slope = (n * sumxy - sumx * sumy) / denom
     return {"slope_kg_per_week": round(slope * 7, 3)}  # variazione settimanale
 
 # ---------------- Workouts ----------------
 @app.post("/workouts")
 def add_workout(w: WorkoutIn, db: Session = Depends(get_db), current: User = Depends(get_current_user)):
+    uid = current.id
     try:
-        wk = Workout(user_id=current.id, when=w.when)
+        wk = Workout(user_id=uid, when=w.when)
         db.add(wk)
         db.flush()
-        for s in w.sets:
-            db.add(Set(workout_id=wk.id, exercise=s.exercise, reps=s.reps, weight_kg=s.weight_kg))
+        if w.sets:
+            db.execute(
+                insert(Set),
+                [{"workout_id": wk.id, "exercise": s.exercise, "reps": s.reps, "weight_kg": s.weight_kg} for s in w.sets],
+            )
         db.commit()
-        return {"ok": True, "workout_id": wk.id, "user_id": current.id}
+        return {"ok": True, "workout_id": wk.id, "user_id": uid}
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=400, detail=f"Errore add_workout: {e}")
 
+# tetto per ?limit= / ?workouts_limit= (negativi o enormi finirebbero dritti nel LIMIT SQL)
+WORKOUTS_LIMIT_MAX = 100
+
 @app.get("/workouts/all")
-def workouts_all(db: Session = Depends(get_db), current: User = Depends(get_current_user)):
-    wks = db.query(Workout).filter(Workout.user_id == current.id).order_by(Workout.when.desc()).all()
-    out = []
-    for w in wks:
-        sets = db.query(Set).filter(Set.workout_id == w.id).all()
-        out.append(
-            {
-                "id": w.id,
-                "when": w.when.isoformat(),
-                "sets": [{"exercise": s.exercise, "reps": s.reps, "weight_kg": s.weight_kg} for s in sets],
-            }
-        )
-    return out
+def workouts_all(
+    limit: Optional[int] = Query(None, ge=1, le=WORKOUTS_LIMIT_MAX),
+    db: Session = Depends(get_db),
+    uid: int = Depends(get_current_user_id),
+):
+    wks = (
+        db.query(Workout)
+        .options(selectinload(Workout.sets))
+        .filter(Workout.user_id == uid)
+        .order_by(Workout.when.desc())
+        .limit(limit)
+        .all()
+    )
+    return [
+        {
+            "id": w.id,
+            "when": w.when.isoformat(),
+            "sets": [{"exercise": s.exercise, "reps": s.reps, "weight_kg": s.weight_kg} for s in w.sets],
+        }
+        for w in wks
+    ]
 
 # ---------------- Day / Week summaries ----------------
 @app.get("/summary/day")
 def summary_day(date: str, db: Session = Depends(get_db), current: User = Depends(get_current_user)):
+    uid = current.id
     try:
-        d0 = datetime.fromisoformat(date)
+        day = datetime.fromisoformat(date)
     except Exception:
         raise HTTPException(status_code=400, detail="Formato data non valido. Usa YYYY-MM-DD")
-    d1 = d0 + timedelta(days=1)
+    # giorno locale dell'utente
+    d0, d1 = local_days_utc(day, 1, ZoneInfo(current.timezone or "Europe/Rome"))
 
-    pro = (
-        db.query(func.sum(MealItem.pro * (MealItem.grams / 100.0)))
+    pro, carb, fat = (
+        db.query(*macro_sums())
+        .select_from(MealItem)
         .join(Meal)
-        .filter(Meal.user_id == current.id, Meal.when >= d0, Meal.when < d1)
-        .scalar()
-        or 0.0
-    )
-    carb = (
-        db.query(func.sum(MealItem.carb * (MealItem.grams / 100.0)))
-        .join(Meal)
-        .filter(Meal.user_id == current.id, Meal.when >= d0, Meal.when < d1)
-        .scalar()
-        or 0.0
-    )
-    fat = (
-        db.query(func.sum(MealItem.fat * (MealItem.grams / 100.0)))
-        .join(Meal)
-        .filter(Meal.user_id == current.id, Meal.when >= d0, Meal.when < d1)
-        .scalar()
-        or 0.0
+        .filter(Meal.user_id == uid, Meal.when >= d0, Meal.when < d1)
+        .one()
     )
     kcal = pro * 4 + carb * 4 + fat * 9
-    return {"kcal": kcal, "pro": pro, "carb": carb, "fat": fat, "user_id": current.id}
+    return {"kcal": kcal, "pro": pro, "carb": carb, "fat": fat, "user_id": uid}
 
 @app.get("/summary/week")
 def summary_week(start: str, db: Session = Depends(get_db), current: User = Depends(get_current_user)):
+    uid = current.id
     try:
-        d0 = datetime.fromisoformat(start)
+        week_start = datetime.fromisoformat(start)
     except Exception:
         raise HTTPException(status_code=400, detail="Formato start non valido. Usa YYYY-MM-DD")
-    d1 = d0 + timedelta(days=7)
-    meals = db.query(Meal).filter(Meal.user_id == current.id, Meal.when >= d0, Meal.when < d1).all()
-    tot_pro = tot_carb = tot_fat = 0.0
-    for m in meals:
-        items = db.query(MealItem).filter(MealItem.meal_id == m.id).all()
-        tot_pro += sum(i.pro * (i.grams / 100.0) for i in items)
-        tot_carb += sum(i.carb * (i.grams / 100.0) for i in items)
-        tot_fat += sum(i.fat * (i.grams / 100.0) for i in items)
+    d0, d1 = local_days_utc(week_start, 7, ZoneInfo(current.timezone or "Europe/Rome"))
+    tot_pro, tot_carb, tot_fat = (
+        db.query(*macro_sums())
+        .select_from(MealItem)
+        .join(Meal)
+        .filter(Meal.user_id == uid, Meal.when >= d0, Meal.when < d1)
+        .one()
+    )
     tot_kcal = tot_pro * 4 + tot_carb * 4 + tot_fat * 9
     return {"week_start": start, "totals": {"kcal": tot_kcal, "pro": tot_pro, "carb": tot_carb, "fat": tot_fat}}
 
@@ -778,24 +977,29 @@ def check_weekly(
     db: Session = Depends(get_db),
     current: User = Depends(get_current_user),
 ):
+    uid = current.id
     try:
-        d0 = datetime.fromisoformat(start)
+        week_start = datetime.fromisoformat(start)
     except Exception:
         raise HTTPException(status_code=400, detail="Formato start non valido. Usa YYYY-MM-DD")
-    d1 = d0 + timedelta(days=7)
-    days = [d0 + timedelta(days=i) for i in range(7)]
+    tz_name = current.timezone or "Europe/Rome"
+    d0, d1 = local_days_utc(week_start, 7, ZoneInfo(tz_name))
+    days = [week_start + timedelta(days=i) for i in range(7)]
+    # totali dei 7 giorni in una sola query, raggruppati per data locale dell'utente (un pasto alle 00:30
+    # ora di Roma conta per quel giorno, non per il precedente in UTC)
+    day_col = local_date(Meal.when, tz_name).label("day")
+    rows = (
+        db.query(day_col, *macro_sums())
+        .select_from(MealItem)
+        .join(Meal)
+        .filter(Meal.user_id == uid, Meal.when >= d0, Meal.when < d1)
+        .group_by(day_col)
+        .all()
+    )
+    by_day = {str(r.day): (r.pro, r.carb, r.fat) for r in rows}
     day_stats = []
     for day in days:
-        d_end = day + timedelta(days=1)
-        items = (
-            db.query(MealItem)
-            .join(Meal)
-            .filter(Meal.user_id == current.id, Meal.when >= day, Meal.when < d_end)
-            .all()
-        )
-        pro = sum(i.pro * (i.grams / 100.0) for i in items)
-        carb = sum(i.carb * (i.grams / 100.0) for i in items)
-        fat = sum(i.fat * (i.grams / 100.0) for i in items)
+        pro, carb, fat = by_day.get(day.date().isoformat(), (0.0, 0.0, 0.0))
         kcal = pro * 4 + carb * 4 + fat * 9
         day_stats.append({"date": day.date().isoformat(), "kcal": kcal, "pro": pro, "carb": carb, "fat": fat})
     protein_days = sum(1 for d in day_stats if d["pro"] >= protein_target_g)
@@ -804,7 +1008,7 @@ def check_weekly(
         kcal_days = sum(1 for d in day_stats if abs(d["kcal"] - kcal_target) <= kcal_target * 0.1)
     workouts_count = (
         db.query(func.count(Workout.id))
-        .filter(Workout.user_id == current.id, Workout.when >= d0, Workout.when < d1)
+        .filter(Workout.user_id == uid, Workout.when >= d0, Workout.when < d1)
         .scalar()
         or 0
     )
@@ -818,6 +1022,21 @@ def check_weekly(
         "kcal_days_within_±10%": kcal_days,
     }
 
+# ---------------- Dashboard ----------------
+@app.get("/dashboard")
+def dashboard(
+    workouts_limit: int = Query(5, ge=1, le=WORKOUTS_LIMIT_MAX),
+    db: Session = Depends(get_db),
+    current: User = Depends(get_current_user),
+):
+    uid = current.id
+    # caricamento iniziale dell'app in una sola richiesta (auth + sessione DB una volta sola)
+    return {
+        "today": meals_today(db=db, current=current),
+        "weight_trend": weights_trend(db=db, uid=uid),
+        "workouts": workouts_all(limit=workouts_limit, db=db, uid=uid),
+    }
+
 # ---------------- Deletes ----------------
 @app.delete("/meals/{meal_id}")
 def delete_meal(
@@ -825,17 +1044,14 @@ def delete_meal(
     db: Session = Depends(get_db),
     current: User = Depends(get_current_user),
 ):
-    m = db.query(Meal).filter(Meal.id == meal_id, Meal.user_id == current.id).first()
+    uid = current.id
+    m = db.scalars(select(Meal).where(Meal.id == meal_id, Meal.user_id == uid)).first()
     if not m:
         raise HTTPException(status_code=404, detail="Meal non trovato per questo utente")
-    try:
-        db.query(MealItem).filter(MealItem.meal_id == m.id).delete(synchronize_session=False)
-        db.delete(m)
-        db.commit()
-        return {"ok": True, "deleted_meal_id": meal_id}
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=400, detail=f"Errore delete_meal: {e}")
+    # gli item li elimina il DB (meal_items.meal_id ON DELETE CASCADE + passive_deletes su Meal.items)
+    db.delete(m)
+    db.commit()
+    return {"ok": True, "deleted_meal_id": meal_id}
 
 @app.delete("/weights/{weight_id}")
 def delete_weight(
@@ -843,75 +1059,115 @@ def delete_weight(
     db: Session = Depends(get_db),
     current: User = Depends(get_current_user),
 ):
-    w = db.query(WeightLog).filter(WeightLog.id == weight_id, WeightLog.user_id == current.id).first()
+    uid = current.id
+    w = db.scalars(select(WeightLog).where(WeightLog.id == weight_id, WeightLog.user_id == uid)).first()
     if not w:
         raise HTTPException(status_code=404, detail="Weight non trovato per questo utente")
-    try:
-        db.delete(w)
-        db.commit()
-        return {"ok": True, "deleted_weight_id": weight_id}
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(status_code=400, detail=f"Errore delete_weight: {e}")
+    db.delete(w)
+    db.commit()
+    return {"ok": True, "deleted_weight_id": weight_id}
 
 # ---------------- Plan (macros + distribuzioni) ----------------
+# upsert costruiti una volta sola: compilati al primo uso e poi riusati dalla cache di SQLAlchemy
+PLAN_DIST_UPSERT = pg_insert(UserDistribution)
+PLAN_DIST_UPSERT = PLAN_DIST_UPSERT.on_conflict_do_update(
+    constraint="uq_dist_plan_group_name",
+    set_={
+        "sort_order": PLAN_DIST_UPSERT.excluded.sort_order,
+        "start_min": PLAN_DIST_UPSERT.excluded.start_min,
+        "end_min": PLAN_DIST_UPSERT.excluded.end_min,
+    },
+).execution_options(render_nulls=True)  # start/end None non spezzano l'INSERT in più batch
+
+PLAN_TARGET_UPSERT = pg_insert(DistributionTarget)
+PLAN_TARGET_UPSERT = PLAN_TARGET_UPSERT.on_conflict_do_update(
+    constraint="uq_target_plan_group_name",
+    set_={
+        "pct_carb": PLAN_TARGET_UPSERT.excluded.pct_carb,
+        "pct_pro": PLAN_TARGET_UPSERT.excluded.pct_pro,
+        "pct_fat": PLAN_TARGET_UPSERT.excluded.pct_fat,
+    },
+)
+
+DAY_MODE_UPSERT = pg_insert(UserDayMode)
+DAY_MODE_UPSERT = DAY_MODE_UPSERT.on_conflict_do_update(
+    constraint="uq_user_day_mode", set_={"is_on": DAY_MODE_UPSERT.excluded.is_on}
+)
+
 @app.get("/plan")
-def get_plan(db: Session = Depends(get_db), current: User = Depends(get_current_user)):
-    plan = db.query(UserPlan).filter_by(user_id=current.id).first()
-    if not plan:
+def get_plan(db: Session = Depends(get_db), uid: int = Depends(get_current_user_id)):
+    cached = PLAN_CACHE.get(uid)
+    if cached is not None:
+        return cached
+    generation = plan_cache_generation(uid)
+
+    # piano + distribuzioni + target: 1 query + 2 SELECT ... IN per le collezioni;
+    # raiseload: ogni altra relazione usata qui solleva invece di fare lazy load (N+1)
+    plan = db.scalars(
+        select(UserPlan)
+        .options(selectinload(UserPlan.distributions), selectinload(UserPlan.targets), raiseload("*"))
+        .where(UserPlan.user_id == uid)
+    ).first()
+    created = plan is None
+    if created:
         # crea piano default e distribuzioni default
-        plan = UserPlan(
-            user_id=current.id,
-            on_kcal=2600, on_carb=360, on_pro=194, on_fat=45,
-            off_kcal=2200, off_carb=200, off_pro=194, off_fat=55,
+        plan = create_default_plan(db, uid)
+
+    # ON prima di OFF, poi sort_order (prima era l'ORDER BY della query); una sola passata per i due gruppi
+    on_dists, off_dists = [], []
+    for d in sorted(plan.distributions, key=lambda d: (not d.is_on, d.sort_order)):
+        (on_dists if d.is_on else off_dists).append(
+            {"name": d.name, "sort_order": d.sort_order, "start_min": d.start_min, "end_min": d.end_min}
         )
-        db.add(plan)
-        db.flush()
-        on_names = ["pre-workout", "intra-workout", "post-workout", "pranzo", "cena"]
-        off_names = ["colazione", "pranzo", "cena", "snack"]
-        for i, n in enumerate(on_names):
-            db.add(UserDistribution(plan_id=plan.id, is_on=True, name=n, sort_order=i))
-        for i, n in enumerate(off_names):
-            db.add(UserDistribution(plan_id=plan.id, is_on=False, name=n, sort_order=i))
-        db.commit(); db.refresh(plan)
-
-    dists = db.query(UserDistribution).filter(UserDistribution.plan_id == plan.id).order_by(
-        UserDistribution.is_on.desc(), UserDistribution.sort_order.asc()
-    ).all()
 
-    # targets map
-    t = db.query(DistributionTarget).filter(DistributionTarget.plan_id == plan.id).all()
-    t_map = {}
-    for x in t:
-        key = ("ON" if x.is_on else "OFF", x.name)
-        t_map[key] = {"pct_carb": x.pct_carb, "pct_pro": x.pct_pro, "pct_fat": x.pct_fat}
+    # percentuali per gruppo, stessa passata singola (nome unico per gruppo grazie al vincolo)
+    on_pcts, off_pcts = [], []
+    for x in plan.targets:
+        (on_pcts if x.is_on else off_pcts).append(
+            {"name": x.name, "pct_carb": x.pct_carb, "pct_pro": x.pct_pro, "pct_fat": x.pct_fat}
+        )
 
-    return {
-        "on_distributions": [
-            {"name": d.name, "sort_order": d.sort_order, "start_min": d.start_min, "end_min": d.end_min}
-            for d in dists if d.is_on
-        ],
-        "off_distributions": [
-            {"name": d.name, "sort_order": d.sort_order, "start_min": d.start_min, "end_min": d.end_min}
-            for d in dists if not d.is_on
-        ],
+    out = {
+        "on_distributions": on_dists,
+        "off_distributions": off_dists,
         "on_limits": {"kcal": plan.on_kcal, "carb": plan.on_carb, "pro": plan.on_pro, "fat": plan.on_fat},
         "off_limits": {"kcal": plan.off_kcal, "carb": plan.off_carb, "pro": plan.off_pro, "fat": plan.off_fat},
-        "on_pcts": [
-            {"name": name, **vals} for (grp, name), vals in t_map.items() if grp == "ON"
-        ],
-        "off_pcts": [
-            {"name": name, **vals} for (grp, name), vals in t_map.items() if grp == "OFF"
-        ],
+        "on_pcts": on_pcts,
+        "off_pcts": off_pcts,
     }
+    if created:
+        db.commit()
+    plan_cache_set(PLAN_CACHE, uid, uid, generation, out)
+    return out
 
 @app.put("/plan")
 def update_plan(payload: PlanPayload, db: Session = Depends(get_db), current: User = Depends(get_current_user)):
-    plan = db.query(UserPlan).filter_by(user_id=current.id).first()
+    uid = current.id
+    # validazioni prima di toccare la sessione: un payload invalido non genera query
+    def check_unique(groups, what):
+        for group in groups:
+            names = [x.name for x in group]
+            if len(names) != len(set(names)):
+                raise HTTPException(status_code=400, detail=f"Nomi {what} duplicati nello stesso gruppo")
+    check_unique((payload.on_distributions, payload.off_distributions), "distribuzione")
+    check_unique((payload.on_pcts, payload.off_pcts), "percentuali")
+
+    # targets: le percentuali di ogni gruppo devono sommare ~100
+    def validate_sum(pcts):
+        # una sola passata per i tre totali
+        sc = sp = sf = 0.0
+        for x in pcts:
+            sc += x.pct_carb; sp += x.pct_pro; sf += x.pct_fat
+        if any(abs(v-100.0) > 0.5 for v in (sc, sp, sf)):
+            raise HTTPException(status_code=400, detail="Le percentuali C/P/F per gruppo devono sommare 100%")
+    validate_sum(payload.on_pcts)
+    validate_sum(payload.off_pcts)
+
+    plan = db.scalars(select(UserPlan).where(UserPlan.user_id == uid)).first()
     if not plan:
         raise HTTPException(status_code=404, detail="Nessun piano trovato per questo utente")
 
-    # aggiorna limiti
+    # aggiorna limiti (l'UPDATE parte col flush unico del commit; la sessione non ha autoflush)
     plan.on_kcal = payload.on_limits.kcal
     plan.on_carb = payload.on_limits.carb
     plan.on_pro = payload.on_limits.pro
@@ -921,45 +1177,67 @@ def update_plan(payload: PlanPayload, db: Session = Depends(get_db), current: Us
     plan.off_carb = payload.off_limits.carb
     plan.off_pro = payload.off_limits.pro
     plan.off_fat = payload.off_limits.fat
-    db.add(plan); db.flush()
 
-    # reset & reinsert distribuzioni
-    db.query(UserDistribution).filter(UserDistribution.plan_id == plan.id).delete(synchronize_session=False)
-    for i, d in enumerate(payload.on_distributions):
-        db.add(UserDistribution(plan_id=plan.id, is_on=True, name=d.name, sort_order=d.sort_order, start_min=d.start_min, end_min=d.end_min))
-    for i, d in enumerate(payload.off_distributions):
-        db.add(UserDistribution(plan_id=plan.id, is_on=False, name=d.name, sort_order=d.sort_order, start_min=d.start_min, end_min=d.end_min))
-
-    # update targets (validate sums ~100 per gruppo)
-    def validate_sum(pcts):
-        sc = sum(x.pct_carb for x in pcts) if pcts else 0
-        sp = sum(x.pct_pro for x in pcts) if pcts else 0
-        sf = sum(x.pct_fat for x in pcts) if pcts else 0
-        if any(abs(v-100.0) > 0.5 for v in (sc, sp, sf)):
-            raise HTTPException(status_code=400, detail="Le percentuali C/P/F per gruppo devono sommare 100%")
-    validate_sum(payload.on_pcts)
-    validate_sum(payload.off_pcts)
-
-    db.query(DistributionTarget).filter(DistributionTarget.plan_id==plan.id).delete(synchronize_session=False)
-    for x in payload.on_pcts:
-        db.add(DistributionTarget(plan_id=plan.id, is_on=True, name=x.name, pct_carb=x.pct_carb, pct_pro=x.pct_pro, pct_fat=x.pct_fat))
-    for x in payload.off_pcts:
-        db.add(DistributionTarget(plan_id=plan.id, is_on=False, name=x.name, pct_carb=x.pct_carb, pct_pro=x.pct_pro, pct_fat=x.pct_fat))
+    # distribuzioni: upsert per (plan, ON/OFF, nome) + delete dei soli nomi spariti dal payload
+    dist_rows = [
+        {"plan_id": plan.id, "is_on": is_on, "name": d.name, "sort_order": d.sort_order, "start_min": d.start_min, "end_min": d.end_min}
+        for is_on, group in ((True, payload.on_distributions), (False, payload.off_distributions))
+        for d in group
+    ]
+    db.execute(
+        delete(UserDistribution)
+        .where(
+            UserDistribution.plan_id == plan.id,
+            ~tuple_(UserDistribution.is_on, UserDistribution.name).in_([(r["is_on"], r["name"]) for r in dist_rows]),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    if dist_rows:
+        db.execute(PLAN_DIST_UPSERT, dist_rows)
+
+    # targets: stesso schema upsert + delete
+    tgt_rows = [
+        {"plan_id": plan.id, "is_on": is_on, "name": x.name, "pct_carb": x.pct_carb, "pct_pro": x.pct_pro, "pct_fat": x.pct_fat}
+        for is_on, group in ((True, payload.on_pcts), (False, payload.off_pcts))
+        for x in group
+    ]
+    db.execute(
+        delete(DistributionTarget)
+        .where(
+            DistributionTarget.plan_id == plan.id,
+            ~tuple_(DistributionTarget.is_on, DistributionTarget.name).in_([(r["is_on"], r["name"]) for r in tgt_rows]),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    if tgt_rows:
+        db.execute(PLAN_TARGET_UPSERT, tgt_rows)
 
     db.commit()
+    invalidate_plan_caches(uid)
 
     return {"ok": True}
 
 # ---------------- Schedule ----------------
 @app.get("/schedule", response_model=SchedulePayload)
-def get_schedule(db: Session = Depends(get_db), current: User = Depends(get_current_user)):
-    rows = db.query(UserDayMode).filter(UserDayMode.user_id==current.id).all()
-    on_days = [r.weekday for r in rows if r.is_on]
-    off_days = [r.weekday for r in rows if not r.is_on]
-    return {"on_days": sorted(on_days), "off_days": sorted(off_days)}
+def get_schedule(db: Session = Depends(get_db), uid: int = Depends(get_current_user_id)):
+    cached = SCHEDULE_CACHE.get(uid)
+    if cached is not None:
+        return cached
+    generation = plan_cache_generation(uid)
+    # solo le due colonne, già ordinate dal DB (index-only scan su ix_udm_user): niente oggetti ORM né sorted()
+    rows = db.execute(
+        select(UserDayMode.weekday, UserDayMode.is_on).where(UserDayMode.user_id==uid).order_by(UserDayMode.weekday)
+    ).all()
+    on_days, off_days = [], []
+    for weekday, is_on in rows:
+        (on_days if is_on else off_days).append(weekday)
+    out = {"on_days": on_days, "off_days": off_days}
+    plan_cache_set(SCHEDULE_CACHE, uid, uid, generation, out)
+    return out
 
 @app.put("/schedule", response_model=SchedulePayload)
 def put_schedule(payload: SchedulePayload, db: Session = Depends(get_db), current: User = Depends(get_current_user)):
+    uid = current.id
     set_on = set(payload.on_days)
     set_off = set(payload.off_days)
     if set_on & set_off:
@@ -967,25 +1245,34 @@ def put_schedule(payload: SchedulePayload, db: Session = Depends(get_db), curren
     if not set_on and not set_off:
         raise HTTPException(status_code=400, detail="Devi impostare almeno un giorno ON o OFF")
 
-    db.query(UserDayMode).filter(UserDayMode.user_id==current.id).delete(synchronize_session=False)
-    for wd in sorted(set_on):
-        db.add(UserDayMode(user_id=current.id, weekday=int(wd), is_on=True))
-    for wd in sorted(set_off):
-        db.add(UserDayMode(user_id=current.id, weekday=int(wd), is_on=False))
+    # upsert dei giorni indicati (vincolo user/weekday) + delete dei soli giorni non più impostati
+    db.execute(
+        delete(UserDayMode)
+        .where(UserDayMode.user_id==uid, UserDayMode.weekday.notin_([int(wd) for wd in set_on | set_off]))
+        .execution_options(synchronize_session=False)
+    )
+    db.execute(
+        DAY_MODE_UPSERT,
+        [{"user_id": uid, "weekday": int(wd), "is_on": True} for wd in sorted(set_on)]
+        + [{"user_id": uid, "weekday": int(wd), "is_on": False} for wd in sorted(set_off)],
+    )
     db.commit()
+    invalidate_plan_caches(uid)
     return {"on_days": sorted(set_on), "off_days": sorted(set_off)}
 
 # ---------------- Debug ----------------
 @app.get("/debug/pingdb")
 def debug_pingdb(db: Session = Depends(get_db)):
-    users = db.query(func.count(User.id)).scalar() or 0
-    meals = db.query(func.count(Meal.id)).scalar() or 0
-    workouts = db.query(func.count(Workout.id)).scalar() or 0
-    weights = db.query(func.count(WeightLog.id)).scalar() or 0
-    plans = db.query(func.count(UserPlan.id)).scalar() or 0
+    # tutti i conteggi in un'unica SELECT di subquery scalari: un round-trip, un solo snapshot
+    counts = db.execute(
+        select(*(
+            select(func.count()).select_from(model).scalar_subquery().label(key)
+            for key, model in (("users", User), ("meals", Meal), ("workouts", Workout), ("weights", WeightLog), ("plans", UserPlan))
+        ))
+    ).one()
     return {
         "ok": True,
-        "counts": {"users": users, "meals": meals, "workouts": workouts, "weights": weights, "plans": plans},
+        "counts": counts._asdict(),
     }
 
 
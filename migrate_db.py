@@ -0,0 +1,117 @@
+from db import engine
+
+# Aggiornamento idempotente dello schema per i DB creati prima delle ultime modifiche ai modelli:
+# create_all crea solo le tabelle mancanti, non aggiunge colonne/vincoli a quelle esistenti.
+# Ogni statement controlla prima il catalogo e tocca le tabelle solo se manca qualcosa: anche
+# ALTER TABLE ... IF NOT EXISTS / CREATE INDEX IF NOT EXISTS prendono il lock sulla tabella, e
+# questo gira a ogni avvio dei worker (un lock su meal_items metterebbe in coda tutte le query).
+# Solo PostgreSQL; su un DB già aggiornato (o nuovo, da create_all / reset_db.py) non fa nulla.
+
+
+def index_missing(name: str, ddl: str) -> str:
+    return f"DO $$ BEGIN IF to_regclass('{name}') IS NULL THEN {ddl}; END IF; END $$"
+
+
+def index_present(name: str, ddl: str) -> str:
+    return f"DO $$ BEGIN IF to_regclass('{name}') IS NOT NULL THEN {ddl}; END IF; END $$"
+
+
+UPGRADE_DDL = [
+    # colonne generate di meal_items (stesse espressioni di MealItem in models.py)
+    """
+    DO $$
+    BEGIN
+        IF (
+            SELECT count(*) FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'meal_items'
+              AND column_name IN ('pro_g', 'carb_g', 'fat_g', 'kcal')
+        ) < 4 THEN
+            ALTER TABLE meal_items
+                ADD COLUMN IF NOT EXISTS pro_g  double precision GENERATED ALWAYS AS (pro * grams / 100.0) STORED,
+                ADD COLUMN IF NOT EXISTS carb_g double precision GENERATED ALWAYS AS (carb * grams / 100.0) STORED,
+                ADD COLUMN IF NOT EXISTS fat_g  double precision GENERATED ALWAYS AS (fat * grams / 100.0) STORED,
+                ADD COLUMN IF NOT EXISTS kcal   double precision GENERATED ALWAYS AS ((pro * 4 + carb * 4 + fat * 9) * grams / 100.0) STORED;
+        END IF;
+    END $$
+    """,
+    # foods.barcode unico (serve a ON CONFLICT (barcode)): l'indice ix_foods_barcode esisteva già ma non unico.
+    # I doppioni vengono accorpati sul Food con id minore (meal_items e recent_foods ripuntati) prima dell'indice.
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (
+            SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = 'ix_foods_barcode' AND i.indisunique
+        ) THEN
+            CREATE TEMP TABLE food_dups ON COMMIT DROP AS
+                SELECT id, min(id) OVER (PARTITION BY barcode) AS keep_id FROM foods WHERE barcode IS NOT NULL;
+            DELETE FROM food_dups WHERE id = keep_id;
+
+            UPDATE meal_items mi SET food_id = d.keep_id FROM food_dups d WHERE mi.food_id = d.id;
+            INSERT INTO recent_foods (user_id, food_id, last_used)
+                SELECT r.user_id, d.keep_id, max(r.last_used)
+                FROM recent_foods r JOIN food_dups d ON r.food_id = d.id
+                GROUP BY r.user_id, d.keep_id
+            ON CONFLICT ON CONSTRAINT uq_recent_food_user_food
+                DO UPDATE SET last_used = GREATEST(recent_foods.last_used, EXCLUDED.last_used);
+            -- le righe recent_foods dei doppioni spariscono col CASCADE
+            DELETE FROM foods f USING food_dups d WHERE f.id = d.id;
+
+            DROP INDEX IF EXISTS ix_foods_barcode;
+            CREATE UNIQUE INDEX ix_foods_barcode ON foods (barcode);
+        END IF;
+    END $$
+    """,
+    # vincolo usato da PUT /plan (ON CONFLICT ON CONSTRAINT uq_dist_plan_group_name); i doppioni tengono l'id minore
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_dist_plan_group_name') THEN
+            DELETE FROM user_distributions a USING user_distributions b
+            WHERE a.plan_id = b.plan_id AND a.is_on = b.is_on AND a.name = b.name AND a.id > b.id;
+            ALTER TABLE user_distributions
+                ADD CONSTRAINT uq_dist_plan_group_name UNIQUE (plan_id, is_on, name);
+        END IF;
+    END $$
+    """,
+    # similarity() di /foods/search + indice trigram
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+            CREATE EXTENSION pg_trgm;
+        END IF;
+    END $$
+    """,
+    index_missing("ix_foods_name_trgm", "CREATE INDEX ix_foods_name_trgm ON foods USING gin (name gin_trgm_ops)"),
+    # indici aggiunti ai modelli (non obbligatori per le query, ma senza restano scan)
+    index_missing("ix_workouts_user_when", 'CREATE INDEX ix_workouts_user_when ON workouts (user_id, "when")'),
+    index_missing(
+        "ix_recent_foods_user_last_used",
+        "CREATE INDEX ix_recent_foods_user_last_used ON recent_foods (user_id, last_used DESC)",
+    ),
+    index_missing(
+        "ix_dt_plan_ison",
+        "CREATE INDEX ix_dt_plan_ison ON distribution_targets (plan_id, is_on) INCLUDE (id, name, pct_carb, pct_pro, pct_fat)",
+    ),
+    index_missing("ix_udm_user", "CREATE INDEX ix_udm_user ON user_day_modes (user_id) INCLUDE (weekday, is_on)"),
+    # indici a colonna singola sostituiti dai covering qui sopra (index=True tolto dai modelli)
+    index_present("ix_distribution_targets_plan_id", "DROP INDEX ix_distribution_targets_plan_id"),
+    index_present("ix_user_day_modes_user_id", "DROP INDEX ix_user_day_modes_user_id"),
+]
+
+
+def upgrade_schema(bind=engine):
+    if bind.dialect.name != "postgresql":
+        return
+    with bind.begin() as conn:
+        # più worker uvicorn partono insieme: uno solo alla volta applica le modifiche
+        conn.exec_driver_sql("SELECT pg_advisory_xact_lock(hashtext('macroscoach_upgrade_schema'))")
+        for ddl in UPGRADE_DDL:
+            conn.exec_driver_sql(ddl)
+
+
+if __name__ == "__main__":
+    print("Upgrading schema...")
+    upgrade_schema()
+    print("✅ Schema aggiornato")
@@ -1,6 +1,6 @@
 from datetime import datetime
 from sqlalchemy import (
-    Column, Integer, String, Float, DateTime, ForeignKey, Boolean, UniqueConstraint, Index
+    Column, Integer, String, Float, DateTime, ForeignKey, Boolean, UniqueConstraint, Index, DDL, event, Computed
 )
 from sqlalchemy.orm import relationship
 from db import Base
@@ -22,7 +22,7 @@ class Food(Base):
     __tablename__ = "foods"
     id = Column(Integer, primary_key=True)
     name = Column(String, index=True, nullable=False)
-    barcode = Column(String, index=True, nullable=True)  # opzionale
+    barcode = Column(String, unique=True, index=True, nullable=True)  # opzionale, un Food per barcode
     per_100g_kcal = Column(Float, default=0)
     per_100g_pro = Column(Float, default=0)
     per_100g_carb = Column(Float, default=0)
@@ -31,6 +31,22 @@ class Food(Base):
 
     items = relationship("MealItem", back_populates="food", cascade="all, delete", passive_deletes=True)
 
+    __table_args__ = (
+        # ricerca per sottostringa (ILIKE '%q%') su Postgres: indice trigram GIN
+        Index(
+            "ix_foods_name_trgm", "name",
+            postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"},
+        ).ddl_if(dialect="postgresql"),
+    )
+
+
+# pg_trgm serve all'indice trigram: va creata prima della tabella foods
+event.listen(
+    Food.__table__,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect="postgresql"),
+)
+
 
 # -------------------------
 # Pasti
@@ -44,7 +60,8 @@ class Meal(Base):
     # Distribuzione/slot: NOT NULL nella logica applicativa (DB può risultare NULL se tabelle sono create su db esistente)
     slot = Column(String, nullable=False, default="__MISSING__")
 
-    items = relationship("MealItem", back_populates="meal", cascade="all, delete-orphan")
+    # passive_deletes: le righe figlie le elimina il DB (ondelete=CASCADE), niente SELECT degli item su delete
+    items = relationship("MealItem", back_populates="meal", cascade="all, delete-orphan", passive_deletes=True)
 
     __table_args__ = (
         Index("ix_meals_user_when", "user_id", "when"),
@@ -64,6 +81,13 @@ class MealItem(Base):
     carb  = Column(Float, default=0)
     fat   = Column(Float, default=0)
 
+    # grammi effettivi dell'item, calcolati dal DB (GENERATED ... STORED): le somme diventano SUM(pro_g)
+    pro_g  = Column(Float, Computed("pro * grams / 100.0", persisted=True))
+    carb_g = Column(Float, Computed("carb * grams / 100.0", persisted=True))
+    fat_g  = Column(Float, Computed("fat * grams / 100.0", persisted=True))
+    # una colonna generata non può riferirsi ad altre colonne generate
+    kcal   = Column(Float, Computed("(pro * 4 + carb * 4 + fat * 9) * grams / 100.0", persisted=True))
+
     meal = relationship("Meal", back_populates="items")
     food = relationship("Food", back_populates="items")
 
@@ -80,6 +104,10 @@ class Workout(Base):
 
     sets = relationship("Set", back_populates="workout", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        Index("ix_workouts_user_when", "user_id", "when"),
+    )
+
 
 class Set(Base):
     __tablename__ = "sets"
@@ -121,6 +149,7 @@ class RecentFood(Base):
 
     __table_args__ = (
         UniqueConstraint("user_id", "food_id", name="uq_recent_food_user_food"),
+        Index("ix_recent_foods_user_last_used", user_id, last_used.desc()),
     )
 
 
@@ -161,13 +190,17 @@ class UserDistribution(Base):
     start_min = Column(Integer, nullable=True)
     end_min = Column(Integer, nullable=True)
 
+    __table_args__ = (
+        UniqueConstraint("plan_id", "is_on", "name", name="uq_dist_plan_group_name"),
+    )
+
     plan = relationship("UserPlan", back_populates="distributions")
 
 
 class DistributionTarget(Base):
     __tablename__ = "distribution_targets"
     id = Column(Integer, primary_key=True, index=True)
-    plan_id = Column(Integer, ForeignKey("user_plans.id", ondelete="CASCADE"), nullable=False, index=True)
+    plan_id = Column(Integer, ForeignKey("user_plans.id", ondelete="CASCADE"), nullable=False)
     is_on = Column(Boolean, nullable=False)      # True=ON, False=OFF
     name = Column(String, nullable=False)        # nome distribuzione (match by name)
     pct_carb = Column(Float, nullable=False, default=0.0)
@@ -176,6 +209,11 @@ class DistributionTarget(Base):
 
     __table_args__ = (
         UniqueConstraint("plan_id", "is_on", "name", name="uq_target_plan_group_name"),
+        # covering: il caricamento dei target di un piano (GET /plan) diventa un index-only scan
+        Index(
+            "ix_dt_plan_ison", "plan_id", "is_on",
+            postgresql_include=["id", "name", "pct_carb", "pct_pro", "pct_fat"],
+        ),
     )
 
     plan = relationship("UserPlan", back_populates="targets")
@@ -188,10 +226,12 @@ class DistributionTarget(Base):
 class UserDayMode(Base):
     __tablename__ = "user_day_modes"
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     weekday = Column(Integer, nullable=False)  # 0=Mon .. 6=Sun
     is_on = Column(Boolean, nullable=False)
 
     __table_args__ = (
         UniqueConstraint("user_id", "weekday", name="uq_user_day_mode"),
+        # covering per GET /schedule e il profilo del giorno (sostituisce l'indice semplice su user_id)
+        Index("ix_udm_user", "user_id", postgresql_include=["weekday", "is_on"]),
     )